@@ -1,17 +1,20 @@
 import os
 import sys
+import asyncio
+import argparse
 import re
+import hashlib
 import logging
-import time
-from pathlib import Path
 from datetime import date, datetime
 import pytz
 import pandas as pd
-import requests
+import xlsxwriter
+import ijson
+import orjson
 from google.oauth2 import service_account
 import gspread
-from gspread_dataframe import set_with_dataframe
 from dotenv import load_dotenv
+from odoo_common import new_session, company_session, dataframe_to_values, open_sheet, replace_values
 
 # ===== Setup Logging =====
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
@@ -48,10 +51,21 @@ log.info(f"Using FROM_DATE={FROM_DATE}, TO_DATE={TO_DATE}")
 DOWNLOAD_DIR = os.path.join(os.getcwd(), "download")
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-session = requests.Session()
+session = new_session()
 USER_ID = None
 
+# ===== Google Sheets client (authorized once per run) =====
+SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+CREDS = service_account.Credentials.from_service_account_file('gcreds.json', scopes=SCOPES)
+GS_CLIENT = gspread.authorize(CREDS)
+
 # ===== Utility Functions =====
+_SLUG = re.compile(r'\W+')
+
+def slug(name):
+    # "Metal_Trims" -> "metal_trims"; used for SHEET_INFO keys and download file names
+    return _SLUG.sub('_', name.lower())
+
 def login():
     global USER_ID
     payload = {
@@ -64,7 +78,7 @@ def login():
     }
     r = session.post(f"{ODOO_URL}/web/session/authenticate", json=payload)
     r.raise_for_status()
-    result = r.json().get("result")
+    result = orjson.loads(r.content).get("result")
     if result and "uid" in result:
         USER_ID = result["uid"]
         log.info(f"✅ Logged in (uid={USER_ID})")
@@ -94,43 +108,18 @@ def get_companies():
     }
     r = session.post(f"{ODOO_URL}/web/dataset/call_kw/res.company/search_read", json=payload)
     r.raise_for_status()
-    companies = {c["id"]: c["name"] for c in r.json()["result"]}
+    companies = {c["id"]: c["name"] for c in orjson.loads(r.content)["result"]}
     log.info(f"🏢 Fetched companies: {companies}")
     return companies
 
-def switch_company(company_id):
-    if USER_ID is None:
-        raise Exception("User not logged in yet")
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "call",
-        "params": {
-            "model": "res.users",
-            "method": "write",
-            "args": [[USER_ID], {"company_id": company_id}],
-            "kwargs": {
-                "context": {
-                    "allowed_company_ids": [company_id],
-                    "company_id": company_id
-                }
-            }
-        }
-    }
-    r = session.post(f"{ODOO_URL}/web/dataset/call_kw", json=payload)
-    r.raise_for_status()
-    if "error" in r.json():
-        log.error(f"❌ Failed to switch to company {company_id}: {r.json()['error']}")
-        return False
-    else:
-        log.info(f"🔄 Session switched to company {company_id}")
-        return True
-
-def fetch_fg_store_datas(company_id, cname, from_date, to_date):
+def fetch_fg_store_datas(company_id, cname, from_date, to_date, sess=session):
     context = {
         "lang": "en_US",
         "tz": "Asia/Dhaka",
         "uid": USER_ID,
-        "allowed_company_ids": [company_id]
+        "allowed_company_ids": [company_id],
+        "company_id": company_id,
+        "force_company": company_id
     }
     payload = {
         "jsonrpc": "2.0",
@@ -142,85 +131,168 @@ def fetch_fg_store_datas(company_id, cname, from_date, to_date):
             "kwargs": {"context": context}
         }
     }
-    r = session.post(f"{ODOO_URL}/web/dataset/call_kw/operation.details/retrieve_fg_store_datas", json=payload)
+    r = sess.post(
+        f"{ODOO_URL}/web/dataset/call_kw/operation.details/retrieve_fg_store_datas",
+        json=payload,
+        stream=True
+    )
     r.raise_for_status()
     try:
-        data = r.json()["result"]
-        if isinstance(data, list):
-            def flatten_record(record):
-                return {
-                    k: v[1] if isinstance(v, list) and len(v) == 2 else 
-                    (v.get("display_name") if isinstance(v, dict) and "display_name" in v else v) 
-                    for k, v in record.items()
-                }
-            flattened = [flatten_record(rec) for rec in data if isinstance(rec, dict)]
-            log.info(f"📊 {cname}: {len(flattened)} rows fetched (flattened)")
-            return flattened
-        else:
-            log.warning(f"⚠️ Unexpected data format for {cname}: {type(data)}")
-            return []
+        # Parse records straight off the socket instead of materializing the whole response
+        r.raw.decode_content = True
+        df = flatten_to_df(ijson.items(rpc_events(r.raw), "result.item"))
+        log.info(f"📊 {cname}: {len(df)} rows fetched (flattened)")
+        return df
     except Exception as e:
         log.error(f"❌ {cname}: Failed to parse data: {e}")
-        return []
-
-# ====== Function to save records using regex-friendly pattern ======
-def save_records_to_excel(records, company_name):
-    if records:
-        df = pd.DataFrame(records)
-        company_clean = re.sub(r'\W+', '_', company_name.lower())
-        output_file = os.path.join(DOWNLOAD_DIR, f"{company_clean}_fg_store_datas_{today.isoformat()}.xlsx")
-        df.to_excel(output_file, index=False)
+        return pd.DataFrame()
+    finally:
+        r.close()
+
+def rpc_events(stream):
+    # ijson events for a JSON-RPC response; raises with Odoo's message if it carries an error
+    error = {}
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if prefix.startswith("error"):
+            if event == "string":
+                error[prefix] = value
+            elif prefix == "error" and event == "end_map":
+                raise Exception(error.get("error.data.message") or error.get("error.message"))
+        yield prefix, event, value
+
+def flatten_value(value):
+    # Odoo many2one [id, name] -> name, {"display_name": ...} -> display_name
+    if isinstance(value, list) and len(value) == 2:
+        return value[1]
+    if isinstance(value, dict) and "display_name" in value:
+        return value["display_name"]
+    return value
+
+def many2one_name(value):
+    # [id, name] -> name; False and x2many lists of any other length pass through unchanged
+    return value[1] if value.__class__ is list and len(value) == 2 else value
+
+def display_name(value):
+    return value.get("display_name", value) if isinstance(value, dict) else value
+
+def keep_value(value):
+    return value
+
+def pick_reducer(sample):
+    # Every record has the same schema, so one value tells us how to reduce the whole column;
+    # empty (False/None) samples and other containers fall back to the generic checks
+    if isinstance(sample, list) and len(sample) == 2:
+        return many2one_name
+    if isinstance(sample, dict) and "display_name" in sample:
+        return display_name
+    if sample is False or sample is None or isinstance(sample, (list, dict)):
+        return flatten_value
+    return keep_value
+
+def flatten_to_df(records):
+    # One pre-made list per field of the first record (all records share that schema), filled
+    # while records stream in, so the frame is built from columns without a list of dicts
+    cols, reducers = {}, {}
+    for rec in records:
+        if isinstance(rec, dict):
+            if not reducers:
+                reducers = {k: pick_reducer(v) for k, v in rec.items()}
+                cols = {k: [] for k in reducers}
+            for k, reducer in reducers.items():
+                v = rec.get(k)
+                cols[k].append(reducer(v) if v is not None else None)
+    df = pd.DataFrame(cols, copy=False)
+    # Odoo sends False for empty fields; turn it into a real null once so numeric
+    # columns keep their dtype and blanks are filled in when building sheet values
+    for col in df.select_dtypes(include=["bool", "object"]).columns:
+        df[col] = df[col].where(df[col] != False, None)
+    return df
+
+# ====== Function to archive the DataFrame using regex-friendly pattern ======
+def save_records(df, company_name, company_slug, xlsx=False):
+    if not df.empty:
+        output_base = os.path.join(DOWNLOAD_DIR, f"{company_slug}_fg_store_datas_{today.isoformat()}")
+        if xlsx:
+            output_file = f"{output_base}.xlsx"
+            # Streaming writer flushes each row as it goes; constant_memory needs strict row order,
+            # which pandas' column-wise to_excel does not give, so rows are written directly
+            workbook = xlsxwriter.Workbook(output_file, {"constant_memory": True, "nan_inf_to_errors": True})
+            worksheet = workbook.add_worksheet()
+            for row_idx, row in enumerate(dataframe_to_values(df)):
+                worksheet.write_row(row_idx, 0, row)
+            workbook.close()
+        else:
+            # Arrow needs one type per column; Odoo mixes False into text columns
+            output_file = f"{output_base}.feather"
+            text_cols = {col: "string" for col in df.columns[df.dtypes == object]}
+            df.astype(text_cols).to_feather(output_file, compression="zstd")
         log.info(f"📂 Saved: {output_file}")
         return output_file
     else:
         log.warning(f"❌ No data fetched for {company_name}")
         return None
 
-# ====== Function to paste downloaded files into Google Sheet ======
-def paste_downloaded_file_to_gsheet(company_name, sheet_key, worksheet_name):
-    try:
-        company_clean = re.sub(r'\W+', '_', company_name.lower())
-        files = list(Path(DOWNLOAD_DIR).glob(f"{company_clean}_fg_store_datas_*.xlsx"))
-        if not files:
-            log.warning(f"⚠️ No downloaded file found for {company_name}")
-            return
-        
-        files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-        latest_file = files[0]
-        df = pd.read_excel(latest_file)
-        
-        # Drop first column if exists
-        if df.shape[1] > 1:
-            df = df.iloc[:, 1:]
-        
-        log.info(f"✅ Loaded file {latest_file.name} into DataFrame (first column dropped)")
+# ====== Google Sheet helpers ======
+def values_digest(values):
+    # Hash of exactly what gets uploaded, used to skip re-uploading unchanged data
+    return hashlib.blake2b(orjson.dumps(values), digest_size=16).hexdigest()
 
-        scope = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
-        creds = service_account.Credentials.from_service_account_file('gcreds.json', scopes=scope)
-        client = gspread.authorize(creds)
-        
-        sheet = client.open_by_key(sheet_key)
-        worksheet = sheet.worksheet(worksheet_name)
-        
+# ====== Function to paste the in-memory DataFrame into Google Sheet ======
+def paste_to_gsheet(company_name, df, sheet_key, worksheet_name):
+    try:
         if df.empty:
             log.warning(f"⚠️ DataFrame for {company_name} is empty. Skipping paste.")
             return
-        df = df.replace(False, "") 
-        worksheet.batch_clear(["A:L"])
-        time.sleep(2)
-        set_with_dataframe(worksheet, df)
-        log.info(f"✅ Data pasted into Google Sheet ({worksheet_name}) for {company_name}")
-        
+
+        sheet = open_sheet(GS_CLIENT, sheet_key)
+        worksheet = sheet.worksheet(worksheet_name)
         local_tz = pytz.timezone('Asia/Dhaka')
         local_time = datetime.now(local_tz).strftime("%Y-%m-%d %H:%M:%S")
-        worksheet.update("M1", [[f"{local_time}"]])
+
+        # N1 holds the hash of the last upload; when nothing changed only refresh the timestamp
+        values = dataframe_to_values(df)
+        digest = values_digest(values)
+        if worksheet.acell("N1").value == digest:
+            worksheet.update(range_name="M1", values=[[local_time]])
+            log.info(f"⏭️ {company_name}: data unchanged since last run, timestamp updated: {local_time}")
+            return
+
+        # Clear A:L and the old hash in N1, then paste and stamp M1/N1 in one update (leading '
+        # keeps those cells as text); if the update fails, no stale hash is left beside empty data
+        replace_values(worksheet, values, ["A:L", "N1"], {"M1": f"'{local_time}", "N1": f"'{digest}"})
+        log.info(f"✅ Data pasted into Google Sheet ({worksheet_name}) for {company_name}")
         log.info(f"✅ Timestamp updated: {local_time}")
         
     except Exception as e:
-        log.error(f"❌ Error in paste_downloaded_file_to_gsheet({company_name}): {e}")
+        log.error(f"❌ Error in paste_to_gsheet({company_name}): {e}")
+
+# ====== Per-company pipeline ======
+async def run_company(cid, cname, xlsx=False):
+    sess = company_session(session)
+    log.info(f"🔍 Processing {cname} (Company ID: {cid})")
+
+    records_df = await asyncio.to_thread(fetch_fg_store_datas, cid, cname, FROM_DATE, TO_DATE, sess)
+    company_slug = slug(cname)
+    await asyncio.to_thread(save_records, records_df, cname, company_slug, xlsx)
+
+    # The archive keeps every column; the sheet layout starts after the first one
+    df = records_df.iloc[:, 1:] if records_df.shape[1] > 1 else records_df
+
+    # Push to Google Sheet
+    sheet_info = SHEET_INFO.get(company_slug)
+    if sheet_info:
+        await asyncio.to_thread(
+            paste_to_gsheet,
+            cname,
+            df,
+            sheet_info["sheet_id"],
+            sheet_info["worksheet_name"]
+        )
+    else:
+        log.warning(f"⚠️ No Google Sheet mapping found for {cname}")
 
 # ====== Main Workflow ======
-if __name__ == "__main__":
+async def main(xlsx=False):
     userinfo = login()
     log.info(f"User info (allowed companies): {userinfo.get('user_companies', {})}")
 
@@ -230,23 +302,10 @@ if __name__ == "__main__":
         3: "Metal_Trims"    # Company ID 3 → Metal Trims
     }
 
-    for cid, cname in target_companies.items():
-        if not switch_company(cid):
-            log.warning(f"⚠️ Failed to switch to company {cid} ({cname}), skipping...")
-            continue
-
-        log.info(f"🔍 Processing {cname} (Company ID: {cid})")
+    await asyncio.gather(*(run_company(cid, cname, xlsx) for cid, cname in target_companies.items()))
 
-        records = fetch_fg_store_datas(cid, cname, FROM_DATE, TO_DATE)
-        save_records_to_excel(records, cname)
-
-        # Push to Google Sheet
-        sheet_info = SHEET_INFO.get(re.sub(r'\W+', '_', cname.lower()))
-        if sheet_info:
-            paste_downloaded_file_to_gsheet(
-                cname,
-                sheet_info["sheet_id"],
-                sheet_info["worksheet_name"]
-            )
-        else:
-            log.warning(f"⚠️ No Google Sheet mapping found for {cname}")
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Push Odoo FG store data to the dashboard Google Sheet")
+    parser.add_argument("--xlsx", action="store_true", help="archive downloads as .xlsx instead of .feather")
+    args = parser.parse_args()
+    asyncio.run(main(xlsx=args.xlsx))
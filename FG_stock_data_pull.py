@@ -1,11 +1,12 @@
 import os
-import requests
+import asyncio
+import orjson
 import pandas as pd
 from datetime import datetime
 import pytz
 import gspread
-from gspread_dataframe import set_with_dataframe
 from google.oauth2.service_account import Credentials
+from odoo_common import new_session, company_session, dataframe_to_values, open_sheet, replace_values
 
 # ========= CONFIG ==========
 ODOO_URL = os.getenv("ODOO_URL")
@@ -20,7 +21,7 @@ COMPANIES = {
     3: {"name": "Metal Trims", "sheet": "MT FG live Stock"},
 }
 
-session = requests.Session()
+session = new_session()
 USER_ID = None
 
 # ========= GOOGLE SHEETS ==========
@@ -43,46 +44,23 @@ def login():
     }
     r = session.post(f"{ODOO_URL}/web/session/authenticate", json=payload)
     r.raise_for_status()
-    result = r.json().get("result")
+    result = orjson.loads(r.content).get("result")
     if result and "uid" in result:
         USER_ID = result["uid"]
         print(f"✅ Logged in (uid={USER_ID})")
     else:
         raise Exception("❌ Odoo login failed")
 
-# ========= SWITCH COMPANY ==========
-def switch_company(company_id):
-    payload = {
-        "jsonrpc": "2.0",
-        "method": "call",
-        "params": {
-            "model": "res.users",
-            "method": "write",
-            "args": [[USER_ID], {"company_id": company_id}],
-            "kwargs": {
-                "context": {
-                    "allowed_company_ids": [company_id],
-                    "company_id": company_id
-                }
-            }
-        }
-    }
-    r = session.post(f"{ODOO_URL}/web/dataset/call_kw", json=payload)
-    r.raise_for_status()
-    if "error" in r.json():
-        print(f"❌ Failed to switch to company {company_id}")
-        return False
-    print(f"🔄 Switched to company {company_id}")
-    return True
-
 # ========= FETCH OPERATION DETAILS ==========
-def fetch_operation_details(company_id, report_id):
+def fetch_operation_details(company_id, report_id, sess=session):
     context = {
         "lang": "en_US",
         "tz": "Asia/Dhaka",
         "uid": USER_ID,
         "allowed_company_ids": [company_id],
-        "current_company_id": company_id
+        "current_company_id": company_id,
+        "company_id": company_id,
+        "force_company": company_id
     }
     payload = {
         "jsonrpc": "2.0",
@@ -94,78 +72,88 @@ def fetch_operation_details(company_id, report_id):
             "kwargs": {"context": context}
         }
     }
-    r = session.post(
+    r = sess.post(
         f"{ODOO_URL}/web/dataset/call_kw/operation.details/retrive_data_from_operation_details",
         json=payload
     )
     r.raise_for_status()
-    data = r.json().get("result", [])
+    data = orjson.loads(r.content).get("result", [])
     df = pd.DataFrame(data)
     print(f"📦 {COMPANIES[company_id]['name']}: {len(df)} rows fetched")
     return df
 
 # ========= PROCESS DATA ==========
+# Odoo entry field -> sheet header, in sheet column order
+FIELD_MAP = {
+    'oa_name': 'OA',
+    'date_order': 'Order Date',
+    'closing_date': 'Closing Date',
+    'sample': 'Sample',
+    'pi': 'PI',
+    'partner_id': 'Customer',
+    'buyer_id': 'Buyer',
+    'invoice_line_id': 'Invoice No',
+    'invoice_date': 'Invoice Date',
+    'lc_number': 'LC Number',
+    'lc_date': 'LC Date',
+    'sales_person': 'Sales Person',
+    'region': 'Region',
+    'dsm': 'DSM',
+    'fg_categ_type': 'Item',
+    'product_id': 'Product',
+    'order_qty': 'Order QTY',
+    'order_value': 'Order Value',
+    'received_qty': 'Recived QTY',
+    'received_value': 'Recived Value',
+    'goods_in_date': 'Goods In Date',
+    'delivered_qty': 'Delivered QTY',
+    'delivered_value': 'Delivered Value',
+    'delivery_date': 'Delivered Date',
+    'pending_qty': 'Pending QTY',
+    'stock_qty': 'Stock QTY',
+    'stock_value': 'Stock Value',
+    'days_passed': 'Age',
+    'invoice_qty': 'Invoice QTY',
+    'invoice_value': 'Invoice Value',
+}
+OUTPUT_ORDER = list(FIELD_MAP.values())
+
 def process_data(df):
-    all_rows = []
-    for _, row in df.iterrows():
-        entries = row.get('datas') if isinstance(row.get('datas'), list) else row.get('delivery_data')
-        if not isinstance(entries, list):
-            continue
-        for e in entries:
-            all_rows.append({
-                'OA': e.get('oa_name'),
-                'Order Date': e.get('date_order'),
-                'Closing Date': e.get('closing_date'),
-                'Sample': e.get('sample'),
-                'PI': e.get('pi'),
-                'Customer': e.get('partner_id'),
-                'Buyer': e.get('buyer_id'),
-                'Invoice No': e.get('invoice_line_id'),
-                'Invoice Date': e.get('invoice_date'),
-                'LC Number': e.get('lc_number'),
-                'LC Date': e.get('lc_date'),
-                'Sales Person': e.get('sales_person'),
-                'Region': e.get('region'),
-                'DSM': e.get('dsm'),
-                'Item': e.get('fg_categ_type'),
-                'Product': e.get('product_id'),
-                'Order QTY': e.get('order_qty'),
-                'Order Value': e.get('order_value'),
-                'Recived QTY': e.get('received_qty'),
-                'Recived Value': e.get('received_value'),
-                'Goods In Date': e.get('goods_in_date'),
-                'Delivered QTY': e.get('delivered_qty'),
-                'Delivered Value': e.get('delivered_value'),
-                'Delivered Date': e.get('delivery_date'),
-                'Pending QTY': e.get('pending_qty'),
-                'Stock QTY': e.get('stock_qty'),
-                'Stock Value': e.get('stock_value'),
-                'Age': e.get('days_passed'),
-                'Invoice QTY': e.get('invoice_qty'),
-                'Invoice Value': e.get('invoice_value'),
-            })
-    return pd.DataFrame(all_rows)
+    empty = pd.Series(None, index=df.index, dtype=object)
+    datas = df.get('datas', empty)
+    entries = datas.where(datas.map(lambda x: isinstance(x, list)), df.get('delivery_data', empty))
+    entries = entries[entries.map(lambda x: isinstance(x, list))].explode().dropna()
+    if entries.empty:
+        return pd.DataFrame()
+    out = pd.DataFrame(entries.tolist())
+    return out.rename(columns=FIELD_MAP).reindex(columns=OUTPUT_ORDER)
 
 # ========= PASTE TO GOOGLE SHEET ==========
 def paste_to_gsheet(df, sheet_name):
-    sheet = client.open_by_key(SHEET_ID)
+    sheet = open_sheet(client, SHEET_ID)
     ws = sheet.worksheet(sheet_name)
     if df.empty:
         print(f"Skip: {sheet_name} is empty")
         return
-    ws.batch_clear(['A:AD'])
-    set_with_dataframe(ws, df)
-    print(f"✅ Data pasted to {sheet_name}")
     local_tz = pytz.timezone('Asia/Dhaka')
     timestamp = datetime.now(local_tz).strftime("%Y-%m-%d %H:%M:%S")
-    ws.update("AF2", [[timestamp]])
+    # Clear A:AD, then paste and stamp AF2 in one update (leading ' keeps the timestamp as text)
+    replace_values(ws, dataframe_to_values(df), ["A:AD"], {"AF2": f"'{timestamp}"})
+    print(f"✅ Data pasted to {sheet_name}")
     print(f"Timestamp written to AF2: {timestamp}")
 
+# ========= PER-COMPANY PIPELINE ==========
+async def run_company(cid, info):
+    sess = company_session(session)
+    raw_df = await asyncio.to_thread(fetch_operation_details, cid, cid, sess)
+    # Keep the flatten off the event loop so the other company's requests keep moving
+    df = await asyncio.to_thread(process_data, raw_df)
+    await asyncio.to_thread(paste_to_gsheet, df, info["sheet"])
+
 # ========= MAIN ==========
-if __name__ == "__main__":
+async def main():
     login()
-    for cid, info in COMPANIES.items():
-        if switch_company(cid):
-            raw_df = fetch_operation_details(cid, cid)
-            df = process_data(raw_df)
-            paste_to_gsheet(df, info["sheet"])
+    await asyncio.gather(*(run_company(cid, info) for cid, info in COMPANIES.items()))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,76 @@
+import threading
+from numbers import Real
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from gspread.utils import absolute_range_name, rowcol_to_a1
+
+# ========= ODOO HTTP SESSIONS ==========
+REQUEST_TIMEOUT = (10, 600)  # (connect, read) seconds; FG reports can take minutes to compute
+
+class TimeoutHTTPAdapter(HTTPAdapter):
+    def send(self, request, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = REQUEST_TIMEOUT
+        return super().send(request, **kwargs)
+
+def new_session():
+    # Pooled keep-alive connections with a default timeout. Only connection failures and 503
+    # (request never reached a worker) are retried; read timeouts, 502 and 504 usually mean a
+    # long report was already running, and resending it makes Odoo recompute it
+    sess = requests.Session()
+    adapter = TimeoutHTTPAdapter(
+        pool_connections=32,
+        pool_maxsize=32,
+        max_retries=Retry(
+            total=3,
+            connect=3,
+            read=0,
+            backoff_factor=0.3,
+            status_forcelist=[503],
+            allowed_methods=frozenset({"POST"})
+        )
+    )
+    sess.mount("https://", adapter)
+    sess.mount("http://", adapter)
+    sess.headers["Connection"] = "keep-alive"
+    return sess
+
+def company_session(login_session):
+    # Separate connection pool per company; the copied session_id cookie means both
+    # companies still share one server-side Odoo session, so company scoping comes
+    # from the RPC context alone
+    sess = new_session()
+    sess.cookies.update(login_session.cookies)
+    return sess
+
+# ========= GOOGLE SHEETS ==========
+_sheets = {}
+_sheets_lock = threading.Lock()
+
+def open_sheet(client, sheet_key):
+    # Spreadsheets are opened once per run and shared by the concurrent company pipelines
+    with _sheets_lock:
+        if sheet_key not in _sheets:
+            _sheets[sheet_key] = client.open_by_key(sheet_key)
+        return _sheets[sheet_key]
+
+def dataframe_to_values(df):
+    # Header row plus data rows as JSON-ready scalars: blanks for NaN/None, str() for lists/dicts
+    body = df.astype(object).where(df.notna(), "")
+    for col in body.columns[df.dtypes == object]:
+        body[col] = body[col].map(lambda v: v if isinstance(v, (str, Real)) else str(v))
+    return [[str(c) for c in df.columns]] + body.values.tolist()
+
+def replace_values(worksheet, values, clear_ranges, cells=None):
+    # Clear clear_ranges (e.g. ["A:L"]), then write values from A1 and set any extra cells in one
+    # values.batchUpdate. The clear is its own values.batchClear call, so the two are not atomic
+    rows, cols = len(values), len(values[0])
+    if worksheet.row_count < rows or worksheet.col_count < cols:
+        worksheet.resize(rows=max(worksheet.row_count, rows), cols=max(worksheet.col_count, cols))
+    ranges = [absolute_range_name(worksheet.title, r) for r in clear_ranges]
+    worksheet.spreadsheet.values_batch_clear(body={"ranges": ranges})
+    data = [{"range": absolute_range_name(worksheet.title, f"A1:{rowcol_to_a1(rows, cols)}"), "values": values}]
+    for cell, value in (cells or {}).items():
+        data.append({"range": absolute_range_name(worksheet.title, cell), "values": [[value]]})
+    worksheet.spreadsheet.values_batch_update({"valueInputOption": "USER_ENTERED", "data": data})